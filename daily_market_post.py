@@ -6,61 +6,147 @@ Daily Market Summary + S&P 500 Heatmap
 3. Outputs: heatmap image in ./site/ + market text to GITHUB_OUTPUT
 """
 
-import asyncio, os, shutil
+import asyncio, os, random, shutil, time
+from collections import defaultdict, deque
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
+from urllib.parse import urlsplit
 from zoneinfo import ZoneInfo
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, Error as PlaywrightError
 
 # ── Config ──────────────────────────────────────────────────────────────
 SHEET_ID = "1oukBzlyEkFRzTKgmO_6-Zrw6JcEr8k1ZP4Mp-QisDY4"
 GID = "404426642"  # "Score" tab
 
 OUTPUT_DIR = "site"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-DATE_NY = datetime.now(ZoneInfo("America/New_York")).strftime("%Y-%m-%d")
-HEATMAP_PATH = os.path.join(OUTPUT_DIR, f"sp500_heatmap_{DATE_NY}.png")
-HEATMAP_LATEST = os.path.join(OUTPUT_DIR, "sp500_heatmap_latest.png")
+HEATMAP_LATEST = os.path.join(OUTPUT_DIR, "sp500_heatmap_latest.jpg")
+
+
+@lru_cache(maxsize=None)
+def date_ny():
+    """Today's date in New York (YYYY-MM-DD), resolved once on first use."""
+    return datetime.now(ZoneInfo("America/New_York")).strftime("%Y-%m-%d")
+
+
+def heatmap_path():
+    return os.path.join(OUTPUT_DIR, f"sp500_heatmap_{date_ny()}.jpg")
+
 
 FINVIZ_URL = "https://finviz.com/map.ashx"
+# The drawn heatmap (not the #map container, which is visible before it renders);
+# waited on after navigation and then screenshotted
+MAP_SELECTOR = '#map canvas, img[src*="map.ashx"]'
+COOKIE_BANNER_SELECTOR = (
+    'button:has-text("Accept"), button:has-text("I Accept"), '
+    'button:has-text("Agree"), [aria-label*="accept"]'
+)
 REAL_UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
     "AppleWebKit/537.36 (KHTML, like Gecko) "
     "Chrome/124.0.0.0 Safari/537.36"
 )
+CHROMIUM_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--no-sandbox",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-default-apps",
+    "--no-first-run",
+    "--disable-sync",
+    "--mute-audio",
+]
+STEALTH_SCRIPT = """
+Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
+window.chrome = { runtime: {} };
+Object.defineProperty(navigator, 'plugins', { get: () => [1,2,3,4,5] });
+Object.defineProperty(navigator, 'languages', { get: () => ['en-US','en'] });
+"""
+
+# Requests aborted while loading the heatmap page (nothing here affects #map)
+BLOCKED_RESOURCE_TYPES = {"font", "media", "image"}
+BLOCKED_DOMAINS = {
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "doubleclick.net",
+    "amazon-adsystem.com",
+    "scorecardresearch.com",
+    "quantserve.com",
+}
 
 DETAILS_URL = "https://docs.google.com/spreadsheets/d/14yA2ZECdrf4z5qfmFC7_ctOjBZSUZbsqVtQw2pdpN0Y/edit?usp=sharing"
 
+# Slack mrkdwn message; filled by format_slack_message()
+SLACK_TEMPLATE = (
+    "Date: {date} Market\n"
+    "--------------------------------------\n"
+    ":us: S&P 500: {sp500}\n"
+    ":us: Nasdaq: {nasdaq}\n"
+    ":flag-ca: TSX Comp: {tsx}\n"
+    ":seven: Magnificent7: {mags}\n"
+    ":bitcoin: Bitcoin: {btc}\n"
+    ":ethereum: Ethereum: {eth}\n"
+    ":chart_with_upwards_trend: USD/CAD: {usdcad}\n"
+    ":gold-nugget: Gold: {gold}\n"
+    "\n"
+    "Details:\n"
+    + DETAILS_URL + "\n"
+    "\n"
+    "_Percentage change for BTC and ETH is measured relative to the ETF benchmark_"
+)
+
 
 # ── 1. Google Sheet Reader ──────────────────────────────────────────────
-def read_google_sheet():
+@dataclass(slots=True)
+class DailyRow:
+    """One day of market data: row 2 (A2:I2) of the Score tab."""
+    date: str    # A2
+    sp500: str   # B2
+    nasdaq: str  # C2
+    tsx: str     # D2
+    mags: str    # E2
+    btc: str     # F2
+    eth: str     # G2
+    usdcad: str  # H2
+    gold: str    # I2
+
+
+async def read_google_sheet():
     """Read row 2 (A2:I2) from the Score tab via CSV export — no API key needed."""
-    import csv, io, requests
+    import csv, httpx
 
     export_url = (
         f"https://docs.google.com/spreadsheets/d/{SHEET_ID}"
         f"/export?format=csv&gid={GID}"
     )
-    resp = requests.get(export_url, timeout=30)
-    resp.raise_for_status()
-
-    reader = csv.reader(io.StringIO(resp.text))
-    header = next(reader)  # row 1 (headers)
-    row = next(reader)     # row 2 (data)
+    # HTTP/2; the export URL redirects to googleusercontent.com
+    async with httpx.AsyncClient(http2=True, timeout=30, follow_redirects=True) as c:
+        async with c.stream("GET", export_url) as resp:
+            resp.raise_for_status()
+            # Only rows 1-2 are needed: stop reading and drop the connection once two
+            # complete CSV records are in. A quoted cell may span lines, so a record
+            # ends only on a line that leaves an even number of quotes.
+            records, pending, quotes = [], [], 0
+            async for ln in resp.aiter_lines():
+                pending.append(ln)
+                quotes += ln.count('"')
+                if quotes % 2 == 0:
+                    records.append("\n".join(pending))
+                    pending, quotes = [], 0
+                    if len(records) == 2:
+                        break
+
+    rows = list(csv.reader(records))
+    if len(rows) < 2:
+        raise ValueError(f"Expected a header row and a data row, got {len(rows)} row(s)")
+    header = rows[0]  # row 1 (headers)
+    row = rows[1]     # row 2 (data)
 
     if len(row) < 9:
         raise ValueError(f"Expected 9 columns (A-I), got {len(row)}: {row}")
 
-    return {
-        "date":   row[0],   # A2
-        "sp500":  row[1],   # B2
-        "nasdaq": row[2],   # C2
-        "tsx":    row[3],   # D2
-        "mags":   row[4],   # E2
-        "btc":    row[5],   # F2
-        "eth":    row[6],   # G2
-        "usdcad": row[7],   # H2
-        "gold":   row[8],   # I2
-    }
+    return DailyRow(*row[:9])
 
 
 def format_slack_message(d):
@@ -74,130 +160,217 @@ def format_slack_message(d):
         v = str(val).strip()
         return v if v.startswith("$") else "$" + v
 
-    lines = [
-        f"Date: {d['date']} Market",
-        "--------------------------------------",
-        f":us: S&P 500: {fmt_pct(d['sp500'])}",
-        f":us: Nasdaq: {fmt_pct(d['nasdaq'])}",
-        f":flag-ca: TSX Comp: {fmt_pct(d['tsx'])}",
-        f":seven: Magnificent7: {fmt_pct(d['mags'])}",
-        f":bitcoin: Bitcoin: {fmt_pct(d['btc'])}",
-        f":ethereum: Ethereum: {fmt_pct(d['eth'])}",
-        f":chart_with_upwards_trend: USD/CAD: {fmt_usdcad(d['usdcad'])}",
-        f":gold-nugget: Gold: {fmt_pct(d['gold'])}",
-        "",
-        "Details:",
-        DETAILS_URL,
-        "",
-        "_Percentage change for BTC and ETH is measured relative to the ETF benchmark_",
-    ]
-    return "\n".join(lines)
+    return SLACK_TEMPLATE.format(
+        date=d.date,
+        sp500=fmt_pct(d.sp500),
+        nasdaq=fmt_pct(d.nasdaq),
+        tsx=fmt_pct(d.tsx),
+        mags=fmt_pct(d.mags),
+        btc=fmt_pct(d.btc),
+        eth=fmt_pct(d.eth),
+        usdcad=fmt_usdcad(d.usdcad),
+        gold=fmt_pct(d.gold),
+    )
 
 
 # ── 2. Heatmap Screenshot ──────────────────────────────────────────────
+class RateLimiter:
+    """Sliding-window limiter: at most `max_calls` requests per `period` seconds per host."""
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = defaultdict(deque)
+
+    async def acquire(self, host):
+        calls = self._calls[host]
+        while True:
+            now = time.monotonic()
+            while calls and now - calls[0] >= self.period:
+                calls.popleft()
+            if len(calls) < self.max_calls:
+                calls.append(now)
+                return
+            await asyncio.sleep(self.period - (now - calls[0]))
+
+
+# Bounds concurrent Finviz pages and request rate if captures ever run in a loop
+PAGE_SEM = asyncio.Semaphore(2)
+LIMITER = RateLimiter(max_calls=5, period=60)
+
+
 async def goto_with_retries(page, url, attempts=3):
+    sleep_s = 1.0
     for i in range(1, attempts + 1):
         try:
             print(f"[Heatmap] goto attempt {i}/{attempts}")
+            await LIMITER.acquire(urlsplit(url).hostname)
             await page.goto(url, wait_until="domcontentloaded", timeout=90_000)
-            await page.wait_for_load_state("networkidle", timeout=60_000)
+            await page.wait_for_selector(MAP_SELECTOR, timeout=30_000)
             return True
-        except Exception as e:
+        except (PlaywrightError, asyncio.TimeoutError) as e:  # incl. Playwright's TimeoutError
             if i == attempts:
                 print(f"[Heatmap][ERR] goto failed: {e}")
-            await asyncio.sleep(2 + i)
+                break
+            # Decorrelated jitter: spread retries so concurrent runs don't collide
+            sleep_s = random.uniform(1, min(30, sleep_s * 3))
+            await asyncio.sleep(sleep_s)
     return False
 
 
-async def capture_heatmap():
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            args=[
-                "--disable-blink-features=AutomationControlled",
-                "--disable-dev-shm-usage",
-                "--no-sandbox",
-            ],
-        )
+async def block_nonessential(route):
+    """Abort fonts/media/images (except the map itself) and known trackers."""
+    req = route.request
+    host = urlsplit(req.url).hostname or ""
+    domain = ".".join(host.rsplit(".", 2)[-2:])
+    if domain in BLOCKED_DOMAINS or (
+        req.resource_type in BLOCKED_RESOURCE_TYPES and "map.ashx" not in req.url
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+def chromium_args():
+    """Chromium launch args; shared memory goes to disk only if /dev/shm is tiny."""
+    args = list(CHROMIUM_ARGS)
+    try:
+        st = os.statvfs("/dev/shm")
+        shm_small = st.f_frsize * st.f_blocks < 512 * 1024 * 1024  # e.g. Docker's 64MB
+    except (AttributeError, OSError):
+        shm_small = False
+    if shm_small:
+        args.append("--disable-dev-shm-usage")
+    return args
+
+
+# Shared browser, launched once per process; each capture gets its own context.
+_PLAYWRIGHT = None
+_BROWSER = None
+_BROWSER_LOCK = asyncio.Lock()  # concurrent captures (PAGE_SEM) must not double-launch
+
+
+async def get_browser():
+    """Return the shared Chromium instance, (re)launching it if needed."""
+    global _PLAYWRIGHT, _BROWSER
+    async with _BROWSER_LOCK:
+        if _BROWSER is None or not _BROWSER.is_connected():
+            if _PLAYWRIGHT is None:
+                _PLAYWRIGHT = await async_playwright().start()
+            _BROWSER = await _PLAYWRIGHT.chromium.launch(
+                headless=True,
+                args=chromium_args(),
+            )
+        return _BROWSER
+
+
+async def close_browser():
+    """Shut down the shared browser and Playwright driver (call once on exit)."""
+    global _PLAYWRIGHT, _BROWSER
+    if _BROWSER is not None:
+        await _BROWSER.close()
+        _BROWSER = None
+    if _PLAYWRIGHT is not None:
+        await _PLAYWRIGHT.stop()
+        _PLAYWRIGHT = None
+
+
+async def screenshot_heatmap(browser=None):
+    """Render the Finviz page in Chromium and screenshot the map."""
+    async with PAGE_SEM:
+        if browser is None:
+            browser = await get_browser()
         context = await browser.new_context(
             viewport={"width": 1600, "height": 1200},
             user_agent=REAL_UA,
             java_script_enabled=True,
             accept_downloads=False,
         )
-        page = await context.new_page()
-
-        await page.add_init_script("""
-            Object.defineProperty(navigator, 'webdriver', { get: () => undefined });
-            window.chrome = { runtime: {} };
-            Object.defineProperty(navigator, 'plugins', { get: () => [1,2,3,4,5] });
-            Object.defineProperty(navigator, 'languages', { get: () => ['en-US','en'] });
-        """)
-
-        ok = await goto_with_retries(page, FINVIZ_URL, attempts=3)
-        if not ok:
-            await page.goto(FINVIZ_URL, wait_until="load", timeout=120_000)
-
-        # Dismiss cookie banners (best effort)
-        for sel in [
-            'button:has-text("Accept")',
-            'button:has-text("I Accept")',
-            'button:has-text("Agree")',
-            '[aria-label*="accept"]',
-        ]:
+        try:
+            await context.route("**/*", block_nonessential)
+            await context.add_init_script(STEALTH_SCRIPT)
+            page = await context.new_page()
+
+            ok = await goto_with_retries(page, FINVIZ_URL, attempts=3)
+            if not ok:
+                await LIMITER.acquire(urlsplit(FINVIZ_URL).hostname)
+                await page.goto(FINVIZ_URL, wait_until="load", timeout=120_000)
+
+            # Dismiss cookie banner (best effort; usually absent in headless)
             try:
-                await page.locator(sel).first.click(timeout=1500)
+                await page.locator(COOKIE_BANNER_SELECTOR).first.click(timeout=800)
                 await asyncio.sleep(0.4)
-                break
-            except:
+            except PlaywrightError:
                 pass
 
-        # Screenshot map element, fallback to full page
-        saved = False
-        for sel in ["#map", 'div[id*="map"]', 'img[src*="map.ashx"]', "canvas"]:
+            # Screenshot map element, fallback to full page
+            saved = False
             try:
-                el = await page.query_selector(sel)
+                el = await page.query_selector(MAP_SELECTOR)
                 if el:
-                    await el.screenshot(path=HEATMAP_PATH)
+                    await el.screenshot(path=heatmap_path(), type="jpeg", quality=85)
                     saved = True
-                    break
-            except:
+            except PlaywrightError:
                 pass
-        if not saved:
-            await page.screenshot(path=HEATMAP_PATH, full_page=True)
-
-        # Keep a "latest" copy
+            if not saved:
+                await page.screenshot(path=heatmap_path(), type="jpeg", quality=85, full_page=True)
+        finally:
+            await context.close()
+
+
+def link_latest():
+    """Point HEATMAP_LATEST at today's heatmap: hardlink, else symlink, else copy."""
+    path = heatmap_path()
+    try:
+        os.remove(HEATMAP_LATEST)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(path, HEATMAP_LATEST)
+    except OSError:
         try:
-            shutil.copyfile(HEATMAP_PATH, HEATMAP_LATEST)
-        except Exception as e:
-            print(f"[Heatmap][WARN] latest copy failed: {e}")
+            os.symlink(os.path.basename(path), HEATMAP_LATEST)
+        except OSError:
+            shutil.copyfile(path, HEATMAP_LATEST)
+
 
-        print(f"[Heatmap][OK] Saved: {HEATMAP_PATH}")
-        await browser.close()
+async def capture_heatmap(browser=None):
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    await screenshot_heatmap(browser)
+
+    # Keep a "latest" alias
+    try:
+        link_latest()
+    except Exception as e:
+        print(f"[Heatmap][WARN] latest copy failed: {e}")
+
+    print(f"[Heatmap][OK] Saved: {heatmap_path()}")
 
 
 # ── Main ────────────────────────────────────────────────────────────────
 async def main():
     print("=" * 50)
-    print(f"Daily Market Bot — {DATE_NY}")
+    print(f"Daily Market Bot — {date_ny()}")
     print("=" * 50)
 
-    # 1. Read Google Sheet
-    sheet_data = read_google_sheet()
-    message_text = format_slack_message(sheet_data)
+    # 1 + 2. Read Google Sheet and capture heatmap concurrently; if either fails
+    # the TaskGroup cancels and awaits the other before the browser is closed
+    try:
+        async with asyncio.TaskGroup() as tg:
+            sheet_task = tg.create_task(read_google_sheet())
+            tg.create_task(capture_heatmap())
+    finally:
+        await close_browser()
+    message_text = format_slack_message(sheet_task.result())
     print(f"\n[Sheet] Data:\n{message_text}\n")
 
-    # 2. Capture heatmap
-    await capture_heatmap()
-
     # 3. Write message text to GITHUB_OUTPUT for the workflow
     gh_output = os.environ.get("GITHUB_OUTPUT")
     if gh_output:
+        # Use multiline output syntax, appended in a single write
+        payload = f"market_text<<EOF\n{message_text}\nEOF\n"
         with open(gh_output, "a") as f:
-            # Use multiline output syntax
-            f.write("market_text<<EOF\n")
-            f.write(message_text + "\n")
-            f.write("EOF\n")
+            f.write(payload)
         print("[Output] Written to GITHUB_OUTPUT")
     else:
         print("[Output] No GITHUB_OUTPUT (local run)")